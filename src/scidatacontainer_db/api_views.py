@@ -15,7 +15,8 @@ from .models import ContainerType, DataSet, File, Keyword, Software
 from .parsers import parse_container_file
 from .utils import ensure_read_permission, ensure_owner, MetaDBError,\
                    APIResponse as Response
-from .test_utils import download_test_dataset, get_test_data
+from .test_utils import download_test_dataset, get_test_data,\
+                        TEST_UUID_PREFIX
 from . import serializers
 
 
@@ -183,7 +184,7 @@ class DataSetViewSet(ReadOnlyModelViewSet, mixins.CreateModelMixin):
         try:
             obj = DataSet.objects.get(id=pk)
         except DataSet.DoesNotExist:
-            if pk.startswith("00000000-0000-0000-0000-00000000"):
+            if pk.startswith(TEST_UUID_PREFIX):
                 obj = get_test_data(pk)
             else:
                 return Response("", status=404,
@@ -215,7 +216,7 @@ class DataSetViewSet(ReadOnlyModelViewSet, mixins.CreateModelMixin):
         try:
             obj = DataSet.objects.get(id=pk)
         except DataSet.DoesNotExist:
-            if pk.startswith("00000000-0000-0000-0000-00000000"):
+            if pk.startswith(TEST_UUID_PREFIX):
                 return download_test_dataset(pk)
             else:
                 return Response("", status=404,
@@ -323,11 +323,11 @@ class DataSet(DataSetBase):
                       if "change_dataset" in p]
         return Group.objects.filter(name__in=groupnames)
 
-    def update_attributes(self, d, user):
+    def ensure_updatable(self, user):
         """
-        Update a :model:`scidatacontainer_db.DataSet` instance with the
-        information in the dictionary d. It first ensures that the user is the
-        owner of the DataSet.
+        Ensure that the user has write permission for this
+        :model:`scidatacontainer_db.DataSet` and that it is not marked
+        complete.
         """
         if (not user.has_perm("change_dataset", self)) and\
                 (self.owner != user):
@@ -340,6 +340,14 @@ class DataSet(DataSetBase):
                                "msg": "Dataset is marked complete. " +
                                       "No further changes allowed."})
 
+    def update_attributes(self, d, user):
+        """
+        Update a :model:`scidatacontainer_db.DataSet` instance with the
+        information in the dictionary d. It first ensures that the user is the
+        owner of the DataSet.
+        """
+        self.ensure_updatable(user)
+
         if "static" in d:
             if d["static"]:
                 if "hash" not in d:
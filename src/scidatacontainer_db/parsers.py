@@ -2,25 +2,56 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.db import transaction
+from django.db.models import Q
 from django.db.utils import IntegrityError
 
 from abc import ABC, abstractmethod
+import bisect
 import datetime
+import functools
 import json
 import os.path
 import re
+import shutil
 import zipfile
 import magic
-from typing import List
+from typing import List, Optional
+from uuid import uuid4
 
+import orjson
 from packaging import version
 
 from .utils import MetaDBError
 from .models import ContainerType, DataSet, DataSetBase, File, Keyword,\
                     Software
-from .test_utils import parse_test_data
+from .test_utils import parse_test_data, TEST_UUID_PREFIX
 
 
+# integers exceeding 64 bit have at least 19 digits
+_LONG_INT_RE = re.compile(rb'\d{19,}')
+
+
+def _json_loads(data: bytes):
+    """
+    Deserialize a JSON document.
+
+    orjson is used for speed. It rejects some input accepted by the json
+    module, e.g. NaN, and silently converts integers exceeding 64 bit to
+    float, so fall back to json in these cases.
+
+    :param data: JSON document as bytes.
+
+    :return: Deserialized python object.
+    """
+    if _LONG_INT_RE.search(data) is None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+@functools.lru_cache(maxsize=1024)
 def _datetime_parser(datetime_str: str) -> datetime.datetime:
     """
     Convert an ISO 8601 timestamp string to a python datetime object.
@@ -43,6 +74,18 @@ def _datetime_parser(datetime_str: str) -> datetime.datetime:
             return dt.replace(tzinfo=datetime.timezone.utc)
 
 
+@functools.lru_cache(maxsize=128)
+def _parse_ver(version_str: str) -> version.Version:
+    """
+    Convert a version string to a packaging.version.Version object.
+
+    :param version_str: Version string.
+
+    :return: Parsed version.
+    """
+    return version.parse(version_str)
+
+
 def _used_software_parser(used_software_list: List[dict]) -> List[Software]:
     """
     Convert a list of dictionaries of Softwares to a list of Software objects.
@@ -63,10 +106,10 @@ def _replaces_parser(replaces: str) -> DataSet:
 
     :return: DataSet object of the replaced DataSet.
     """
-    try:
-        return DataSet.objects.get(id=replaces)
-    except DataSet.DoesNotExist:
-        return DataSetBase.objects.get_or_create(id=replaces)[0]
+    obj = DataSet.objects.filter(id=replaces).first()
+    if obj is not None:
+        return obj
+    return DataSetBase.objects.get_or_create(id=replaces)[0]
 
 
 def _containerType_parser(container_type: dict) -> ContainerType:
@@ -80,6 +123,7 @@ def _containerType_parser(container_type: dict) -> ContainerType:
     return ContainerType.to_ContainerType(container_type)
 
 
+@transaction.atomic(savepoint=False)
 def _keyword_parser(keywords: List[str]) -> List[Keyword]:
     """
     Convert a list of keyword strings to a list of Keyword objects.
@@ -88,7 +132,78 @@ def _keyword_parser(keywords: List[str]) -> List[Keyword]:
 
     :return: List of Keyword obects.
     """
-    return [Keyword.objects.get_or_create(name=entry)[0] for entry in keywords]
+    names = list(dict.fromkeys(keywords))
+    existing = {k.name: k for k in Keyword.objects.filter(name__in=names)}
+    missing = [Keyword(name=n) for n in names if n not in existing]
+    if missing:
+        # primary keys are set on instantiation, no need to query them again
+        Keyword.objects.bulk_create(missing)
+        existing.update({k.name: k for k in missing})
+    return [existing[n] for n in keywords]
+
+
+# maximum number of files matched per query, larger OR-ed filters exceed
+# the expression depth limit of SQLite
+_FILE_QUERY_BATCH_SIZE = 100
+
+
+def _find_files(files: List[tuple]) -> dict:
+    """
+    Find the files stored in the DB matching a list of
+    (name, size, is_json, content) tuples.
+
+    :param files: List of (name, size, is_json, content) tuples. The content
+    is None for files other than JSON files.
+
+    :return: Dictionary mapping (name, size) to lists of matching File
+    objects.
+    """
+    candidates = {}
+    for i in range(0, len(files), _FILE_QUERY_BATCH_SIZE):
+        query = Q()
+        for name, size, is_json, content in \
+                files[i:i + _FILE_QUERY_BATCH_SIZE]:
+            if not is_json:
+                query |= Q(name=name, size=size)
+            elif content is None:
+                # JSON null is stored as SQL NULL
+                query |= Q(name=name, size=size, content__isnull=True)
+            else:
+                query |= Q(name=name, size=size, content=content)
+        for f in File.objects.filter(query):
+            candidates.setdefault((f.name, f.size), []).append(f)
+    return candidates
+
+
+@transaction.atomic(savepoint=False)
+def _file_parser(files: List[tuple]) -> List[File]:
+    """
+    Convert a list of (name, size, is_json, content) tuples to a list of File
+    objects. Matching files already stored in the DB are reused.
+
+    :param files: List of (name, size, is_json, content) tuples. The content
+    is None for files other than JSON files.
+
+    :return: List of File objects.
+    """
+    candidates = _find_files(files)
+
+    result = []
+    missing = []
+    for name, size, is_json, content in files:
+        matches = candidates.setdefault((name, size), [])
+        for file_obj in matches:
+            if not is_json or file_obj.content == content:
+                break
+        else:
+            file_obj = File(name=name, size=size, content=content)
+            matches.append(file_obj)
+            missing.append(file_obj)
+        result.append(file_obj)
+
+    if missing:
+        File.objects.bulk_create(missing)
+    return result
 
 
 _constraints_1_0_0 = {
@@ -121,7 +236,52 @@ _constraints = {
                 "1.0.0": _constraints_1_0_0,
                 }
 
-MIN_SUPPORTED_VERSION = min([version.parse(k) for k in _constraints.keys()])
+_CAMEL_RE = re.compile(r'(?<!^)(?=[A-Z])')
+
+# Constraints compiled to lists of (key, snake_case name, parser, required)
+# tuples per model version and file. The CamelCase keys are converted to
+# snake_case (more pythonic).
+_COMPILED = {v: {filename: [(key, _CAMEL_RE.sub('_', key).lower(), t,
+                             required)
+                            for key, (t, required) in section.items()]
+                 for filename, section in c.items()}
+             for v, c in _constraints.items()}
+
+# (parsed version, version string, compiled constraints) sorted by version,
+# so the matching constraints can be found by bisection.
+_SORTED_CONSTRAINTS = sorted([(_parse_ver(k), k, v)
+                              for k, v in _COMPILED.items()])
+_SORTED_VERSIONS = [t[0] for t in _SORTED_CONSTRAINTS]
+
+MIN_SUPPORTED_VERSION = _SORTED_VERSIONS[0]
+_MIN_SUPPORTED_STR = str(MIN_SUPPORTED_VERSION)
+
+
+@functools.lru_cache(maxsize=128)
+def _select_constraints(model_version: str) -> dict:
+    """
+    Select the compiled constraints for a model version.
+
+    :param model_version: Model version string as found in "content.json".
+
+    :raises scidatacontainer_db.MetaDBError: If the model version is not
+    supported.
+
+    :return: constraints dictionary.
+    """
+    v = _parse_ver(model_version)
+    if v < MIN_SUPPORTED_VERSION:
+        raise MetaDBError({"error_code": 400,
+                           "msg": "You tried to upload a dataset " +
+                                  "complying scidatacontainer model " +
+                                  "version " + model_version +
+                                  " but the server requires a minimum " +
+                                  "model version of " +
+                                  _MIN_SUPPORTED_STR
+                           })
+    # newest constraints not newer than the model version
+    i = bisect.bisect_right(_SORTED_VERSIONS, v) - 1
+    return _SORTED_CONSTRAINTS[i][2]
 
 
 class BaseParser(ABC):
@@ -131,31 +291,21 @@ class BaseParser(ABC):
     """
     def __init__(self):
         self.model_version = None
+        self.filename = None
 
     @property
     def _constraints(self) -> dict:
         """
-        Return a dict containing (parser, required) pairs of the single files.
+        Return a dict containing lists of (key, name, parser, required)
+        tuples of the single files.
 
         :raises scidatacontainer_db.MetaDBError: If the model version is not
         supported.
 
         :return: constraints dictionary.
         """
-        if not self.model_version:
-            self._read_model_version()
-        v = version.parse(self.model_version)
-        if v < MIN_SUPPORTED_VERSION:
-            raise MetaDBError({"error_code": 400,
-                               "msg": "You tried to upload a dataset " +
-                                      "complying scidatacontainer model " +
-                                      "version " + self.model_version +
-                                      " but the server requires a minimum " +
-                                      "model version of " +
-                                      str(MIN_SUPPORTED_VERSION)
-                               })
-        key = (max([k for k in _constraints.keys() if version.parse(k) <= v]))
-        return _constraints[key]
+        self.model_version = self.content["modelVersion"]
+        return _select_constraints(self.model_version)
 
     @abstractmethod
     def _read_content_json(self):  # pragma: no cover
@@ -180,95 +330,138 @@ class BaseParser(ABC):
     @abstractmethod
     def _read_filelist(self):  # pragma: no cover
         """
-        Create a list of File objects and store it to self.files.
+        Create a list of (name, size, is_json, content) tuples of the files
+        inside the container and store it to self.filelist. The content is
+        None for files other than JSON files.
 
         This method is file type specific and needs to be overwritten by every
         inheriting class.
         """
         pass
 
-    def _read_model_version(self):
+    def _read_container(self):
         """
-        Read the model version from content.json and store it as
-        self.model_version.
+        Read content.json, meta.json and the list of files from the container.
+
+        Inheriting classes may overwrite this method to share resources, e.g.
+        an open file handle, between the single read methods.
         """
-        if "modelVersion" not in self.content:  # pragma: no cover
-            self._read_content_json()
-        self.model_version = self.content["modelVersion"]
+        self._read_content_json()
+        self._read_meta_json()
+        self._read_filelist()
 
-    def _parse_validate(self, filename: str, in_dict: dict) -> dict:
+    def _check_required(self, filename: str, in_dict: dict):
         """
-        Validate the content of a dictionary using the constraints for a
-        specified file.
+        Check that all required items of a specified file are given.
 
-        :param filename: Name of the file to validate. Either "meta" or
+        :param filename: Name of the file to check. Either "meta" or
         "content".
 
         :param in_dict: Dictionary read from file.
 
-        :raise scidatacontainer_db.MetaDBError: If a required item is not found
-        or an error occured during parsing.
-
-        :returns: Dictionary of validated and parsed values.
+        :raise scidatacontainer_db.MetaDBError: If a required item is not
+        found.
         """
-        c = self._constraints[filename]
-        d = {}
-        for key, (t, required) in c.items():
+        for key, _, _, required in self._constraints[filename]:
             if required and key not in in_dict:
                 raise MetaDBError({"error_code": 400,
                                    "msg": "Attribute '" + key +
                                           "' required in " + filename +
                                           ".json."
                                    })
-            if key in in_dict:
-                if in_dict[key] and in_dict[key] != []:
-                    # convert CamelCase to snake_case (more pythonic).
-                    name = re.sub(r'(?<!^)(?=[A-Z])', '_', key).lower()
-                    try:
-                        # try parsing
-                        d[name] = t(in_dict[key])
-                    except ValueError:
-                        raise MetaDBError({"error_code": 400,
-                                           "msg": "Failed to convert '" +
-                                                  in_dict[key] + "' using " +
-                                                  "the default parser. Make " +
-                                                  "sure it has the right type."
-                                           })
+
+    def _parse_validate(self, filename: str, in_dict: dict) -> dict:
+        """
+        Parse the content of a dictionary using the constraints for a
+        specified file.
+
+        :param filename: Name of the file to parse. Either "meta" or
+        "content".
+
+        :param in_dict: Dictionary read from file.
+
+        :raise scidatacontainer_db.MetaDBError: If an error occured during
+        parsing.
+
+        :returns: Dictionary of validated and parsed values.
+        """
+        d = {}
+        for key, name, t, required in self._constraints[filename]:
+            if key not in in_dict:
+                continue
+            value = in_dict[key]
+            if value and value != []:
+                try:
+                    # try parsing
+                    d[name] = t(value)
+                except ValueError:
+                    raise MetaDBError({"error_code": 400,
+                                       "msg": "Failed to convert '" +
+                                              value + "' using " +
+                                              "the default parser. Make " +
+                                              "sure it has the right type."
+                                       })
         return d
 
-    def parse(self, filename: str, user: User) -> DataSet:
+    def read(self, filename: str):
+        """
+        Read the meta data from the file and check that all required items
+        are given. Nothing is stored in the DB.
+
+        :param filename: Filename of the ZDC dataset.
+
+        :raises scidatacontainer_db.MetaDBError: If the model version is not
+        supported or a required item is not found.
+        """
+        self.filename = filename
+        self._read_container()
+        self._check_required("content", self.content)
+        self._check_required("meta", self.meta)
+        self.uuid = str(self.content["uuid"])
+
+    def ensure_updatable(self, user: User):
+        """
+        Ensure that the user may store the dataset read before.
+
+        :param user: User sending the request.
+
+        :raises scidatacontainer_db.MetaDBError: If the dataset exists and the
+        user is not allowed to update it or it is marked complete.
+        """
+        obj = DataSet.objects.filter(id=self.uuid).first()
+        if obj is not None:
+            obj.ensure_updatable(user)
+
+    def parse(self, filename: str, user: User,
+              size: Optional[int] = None) -> DataSet:
         """
         Read the meta data from the file, validate it and store it in the DB.
+        The file is only read if read() was not called for it before.
 
         :param filename: Filename of the ZDC dataset.
         :param user: User sending the request to validate permissions and to
         set ownership.
+        :param size: Size of the dataset in bytes. Defaults to the size of
+        the uploaded file.
         """
-        self.filename = filename
-        self._read_content_json()
-        self._read_meta_json()
-        self._read_filelist()
-        d = {"size": filename.size, "content": self.files}
+        if self.filename is not filename:
+            self.read(filename)
+        if size is None:
+            size = filename.size
+        d = {"size": size, "content": _file_parser(self.filelist)}
         d.update(self._parse_validate("content", self.content))
         d.update(self._parse_validate("meta", self.meta))
 
-        uuid = d["uuid"]
-
-        if uuid.startswith("00000000-0000-0000-0000-00000000"):
-            # These UUIDs are reserved for testing.
-            return parse_test_data(uuid)
-
-        del d["uuid"]
-        if len(DataSetBase.objects.filter(id=uuid)) != 0:
-            if len(DataSet.objects.filter(id=uuid)) != 0:
-                obj = DataSet.objects.get(id=uuid)
+        uuid = d.pop("uuid")
+        base = DataSetBase.objects.filter(id=uuid).first()
+        if base is not None:
+            obj = DataSet.objects.filter(id=uuid).first()
+            if obj is not None:
                 # existing dataset -> try to update
                 return obj.update_attributes(d, user)
-            else:
-                obj = DataSetBase.objects.get(id=uuid)
-                # previously dataset only known by ID
-                # -> delete and replace with full dataset
-                obj.delete()
+            # previously dataset only known by ID
+            # -> delete and replace with full dataset
+            base.delete()
 
         obj = DataSet(id=uuid)
         obj.owner = user
@@ -281,47 +474,54 @@ class ZipContainerParser(BaseParser):
     Parser implementing the file type specific routines for .ZIP based
     containers.
     """
+    def __init__(self):
+        super().__init__()
+        self._zfile = None
+
+    def _read_container(self):
+        """
+        Open the .ZIP based container once and read all required information
+        from it.
+        """
+        with zipfile.ZipFile(self.filename, 'r') as zfile:
+            self._zfile = zfile
+            try:
+                super()._read_container()
+            finally:
+                self._zfile = None
+
     def _read_content_json(self):
         """
         Read the content.json file inside a .ZIP based container.
         """
-        with zipfile.ZipFile(self.filename, 'r') as zfile:
-            with zfile.open("content.json") as content_json:
-                self.content = json.load(content_json)
+        with self._zfile.open("content.json") as content_json:
+            self.content = _json_loads(content_json.read())
 
     def _read_meta_json(self):
         """
         Read the meta.json file inside a .ZIP based container.
         """
-        with zipfile.ZipFile(self.filename, 'r') as zfile:
-            with zfile.open("meta.json") as meta_json:
-                self.meta = json.load(meta_json)
+        with self._zfile.open("meta.json") as meta_json:
+            self.meta = _json_loads(meta_json.read())
 
     def _read_filelist(self):
         """
-        Create a list of File objects inside a .ZIP container and store it to
-        self.files.
+        Create a list of (name, size, is_json, content) tuples of the files
+        inside a .ZIP container and store it to self.filelist.
         """
-        self.files = []
-        with zipfile.ZipFile(self.filename, 'r') as zfile:
-            for _filename in zfile.namelist():
-                size = zfile.getinfo(_filename).file_size
-                name = _filename
-                if _filename.endswith(".json"):
-                    with zfile.open(_filename) as json_file:
-                        data = json.load(json_file)
-                        file_obj, _ = File.objects.get_or_create(name=name,
-                                                                 size=size,
-                                                                 content=data,
-                                                                 )
-                else:
-                    file_obj, _ = File.objects.get_or_create(
-                                    name=_filename,
-                                    size=size,
-                                    )
-                file_obj.save()
-
-                self.files.append(file_obj)
+        # already parsed by _read_content_json() and _read_meta_json()
+        parsed = {"content.json": self.content, "meta.json": self.meta}
+        files = []
+        for info in self._zfile.infolist():
+            is_json = info.filename.endswith(".json")
+            data = None
+            if info.filename in parsed:
+                data = parsed[info.filename]
+            elif is_json:
+                with self._zfile.open(info) as json_file:
+                    data = _json_loads(json_file.read())
+            files.append((info.filename, info.file_size, is_json, data))
+        self.filelist = files
 
 
 class Hdf5ContainerParser(BaseParser):
@@ -341,6 +541,19 @@ class Hdf5ContainerParser(BaseParser):
                           )
 
 
+class _CountingWriter:
+    """
+    Wrapper around a writable file object counting the bytes written.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.fileobj.write(data)
+
+
 def parse_container_file(filename, owner):
     """
     Find the file type, read the meta data from the file,
@@ -351,32 +564,60 @@ def parse_container_file(filename, owner):
     set ownership.
     """
     try:
-        with transaction.atomic():
-            filetype = magic.from_buffer(filename.open("rb").read(2048),
-                                         mime=True)
-            if filetype == "application/zip":
-                parser = ZipContainerParser()
-                obj = parser.parse(filename, owner)
-                #  obj == None for test uploads
-                if not obj:
-                    return
-                server_path = settings.MEDIA_ROOT + "/" + str(obj.id) + ".zdc"
-            elif filetype == "application/x-hdf":
-                parser = Hdf5ContainerParser()
-                obj = parser.parse(filename, owner)
-                server_path = settings.MEDIA_ROOT + "/" + str(obj.id) + ".hdf5"
-            else:
-                raise MetaDBError({"error_code": 415,
-                                   "msg": "File format has to be hdf5 or zip!"
-                                   }
-                                  )
-            server_path = os.path.abspath(server_path)
-            with open(server_path, 'wb+') as destination:
-                for chunk in (filename).chunks():
-                    destination.write(chunk)
-            obj.server_path = server_path
-            obj.save()
+        head = filename.open("rb").read(2048)
+        filename.seek(0)
+        filetype = magic.from_buffer(head, mime=True)
+        if filetype == "application/zip":
+            parser = ZipContainerParser()
+            extension = ".zdc"
+        elif filetype == "application/x-hdf":
+            parser = Hdf5ContainerParser()
+            extension = ".hdf5"
+        else:
+            raise MetaDBError({"error_code": 415,
+                               "msg": "File format has to be hdf5 or zip!"
+                               }
+                              )
+
+        # Check the meta data before anything is written to disk.
+        parser.read(filename)
+        if parser.uuid.startswith(TEST_UUID_PREFIX):
+            # These UUIDs are reserved for testing.
+            return parse_test_data(parser.uuid)
+        parser.ensure_updatable(owner)
+
+        # Store the file before starting the transaction to keep it short.
+        # It is moved to its final location once the dataset is stored.
+        tmp_path = os.path.abspath(settings.MEDIA_ROOT + "/" + uuid4().hex +
+                                   ".part")
+        try:
+            with open(tmp_path, 'xb') as destination:
+                writer = _CountingWriter(destination)
+                filename.seek(0)
+                shutil.copyfileobj(filename, writer, length=1024*1024)
+
+            created = False
+            try:
+                with transaction.atomic():
+                    obj = parser.parse(filename, owner,
+                                       # size of the stored file
+                                       size=writer.count)
+                    server_path = os.path.abspath(settings.MEDIA_ROOT + "/" +
+                                                  str(obj.id) + extension)
+                    obj.server_path = server_path
+                    obj.save()
+                    # Move the file as the last step, so only a failing
+                    # commit can leave it behind.
+                    created = not os.path.exists(server_path)
+                    os.replace(tmp_path, server_path)
+            except BaseException:
+                if created and os.path.exists(server_path):
+                    os.remove(server_path)
+                raise
             return obj
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
     except MetaDBError:
         raise
@@ -8,6 +8,9 @@ from scidatacontainer.tests import get_test_container
 from .utils import APIResponse, MetaDBError
 from .models import DataSet
 
+# UUIDs starting with this prefix are reserved for testing
+TEST_UUID_PREFIX = "00000000-0000-0000-0000-00000000"
+
 
 def parse_test_data(uuid: str):
     """
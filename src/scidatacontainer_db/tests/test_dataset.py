@@ -1,14 +1,21 @@
+from django.conf import settings
 from django.test import TestCase
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.contrib.auth.models import User
 
 from datetime import datetime, timezone, timedelta
+import io
+import json
 import mimetypes
+import os
+from unittest import mock
 import uuid
+import zipfile
 
 from scidatacontainer_db.models import ContainerType, DataSet, Keyword,\
                                        Software, DataSetBase
-from scidatacontainer_db.parsers import parse_container_file
+from scidatacontainer_db.parsers import parse_container_file,\
+                                        ZipContainerParser
 from scidatacontainer_db.utils import MetaDBError
 from . import TESTDIR
 
@@ -196,6 +203,8 @@ class DataSetTest(TestCase):
         self.assertEqual(obj.static, False)
         self.assertEqual(len(obj.used_software.all()), 2)
         self.assertEqual(obj.id, "a31cb576-494f-40c9-af95-e756271278c3")
+        self.assertEqual(obj.size, os.path.getsize(TESTDIR + "example.zdc"))
+        self.assertEqual(obj.size, os.path.getsize(obj.server_path))
 
         self.assertEqual(obj.author, "Reinhard Caspary")
         self.assertEqual(obj.comment, "")
@@ -262,6 +271,120 @@ class DataSetTest(TestCase):
                                       "model version of 1.0.0'}"):
             obj = parse_container_file(file, testuser)
 
+    def _create_modified_file(self, filename, **content):
+        """
+        Copy a container into memory and update items of its content.json.
+        """
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(filename) as src, \
+                zipfile.ZipFile(buffer, "w") as dst:
+            for info in src.infolist():
+                data = src.read(info)
+                if info.filename == "content.json":
+                    c = json.loads(data)
+                    c.update(content)
+                    data = json.dumps(c)
+                dst.writestr(info, data)
+        buffer.seek(0)
+        return InMemoryUploadedFile(file=buffer, name="modified.zdc",
+                                    field_name=None,
+                                    content_type="application/zip",
+                                    charset=None,
+                                    size=len(buffer.getvalue()))
+
+    def test_dataset_parse_error_order(self):
+        testuser = User.objects.create_user("Testuser")
+
+        # test UUIDs are handled before the values are converted
+        file = self._create_modified_file(
+                TESTDIR + "example.zdc",
+                uuid="00000000-0000-0000-0000-000000000409",
+                created="invalid")
+        with self.assertRaisesMessage(MetaDBError, "'error_code': 409"):
+            parse_container_file(file, testuser)
+
+        # permissions and the complete flag are checked before the values
+        # are converted
+        file = self._create_temp_from_file(TESTDIR + "example.zdc")
+        obj = parse_container_file(file, testuser)
+        obj.complete = True
+        obj.save()
+        file = self._create_modified_file(TESTDIR + "example.zdc",
+                                          created="invalid")
+        with self.assertRaisesMessage(MetaDBError, "'error_code': 409"):
+            parse_container_file(file, testuser)
+
+        file = self._create_modified_file(
+                TESTDIR + "example.zdc",
+                uuid="b31cb576-494f-40c9-af95-e756271278c3",
+                created="invalid")
+        with self.assertRaisesMessage(MetaDBError, "Failed to convert"):
+            parse_container_file(file, testuser)
+
+        # missing required attributes are still reported first
+        file = self._create_modified_file(TESTDIR + "example_wo_author.zdc",
+                                          created="invalid")
+        with self.assertRaisesMessage(MetaDBError, "'error_code': 400"):
+            parse_container_file(file, testuser)
+
+    def test_dataset_parse_rejected_not_stored(self):
+        testuser = User.objects.create_user("Testuser")
+        file = self._create_temp_from_file(TESTDIR + "example.zdc")
+        obj = parse_container_file(file, testuser)
+        obj.complete = True
+        obj.save()
+
+        with mock.patch("scidatacontainer_db.parsers.shutil.copyfileobj") \
+                as copy:
+            file = self._create_temp_from_file(TESTDIR + "example_update.zdc")
+            with self.assertRaisesMessage(MetaDBError, "'error_code': 409"):
+                parse_container_file(file, testuser)
+
+            file = self._create_temp_from_file(TESTDIR +
+                                               "example_wo_author.zdc")
+            with self.assertRaisesMessage(MetaDBError, "'error_code': 400"):
+                parse_container_file(file, testuser)
+
+            file = self._create_temp_from_file(TESTDIR +
+                                               "example_version.zdc")
+            with self.assertRaisesMessage(MetaDBError, "'error_code': 400"):
+                parse_container_file(file, testuser)
+
+            copy.assert_not_called()
+
+    def test_dataset_parse_failure_not_stored(self):
+        testuser = User.objects.create_user("Testuser")
+        file = self._create_temp_from_file(TESTDIR + "example.zdc")
+        server_path = os.path.abspath(settings.MEDIA_ROOT + "/" +
+                                      "a31cb576-494f-40c9-af95-e756271278c3" +
+                                      ".zdc")
+        if os.path.exists(server_path):
+            os.remove(server_path)
+
+        def failing_replace(src, dst):
+            # move the file, then fail like a failing commit would
+            os.rename(src, dst)
+            raise OSError("Commit failed")
+
+        with mock.patch("scidatacontainer_db.parsers.os.replace",
+                        failing_replace):
+            with self.assertRaisesMessage(MetaDBError, "Commit failed"):
+                parse_container_file(file, testuser)
+
+        self.assertFalse(os.path.exists(server_path))
+        self.assertFalse(DataSet.objects.filter(
+            id="a31cb576-494f-40c9-af95-e756271278c3").exists())
+        self.assertEqual([f for f in os.listdir(settings.MEDIA_ROOT)
+                          if f.endswith(".part")], [])
+
+    def test_dataset_parse_without_read(self):
+        testuser = User.objects.create_user("Testuser")
+        file = self._create_temp_from_file(TESTDIR + "example.zdc")
+        obj = ZipContainerParser().parse(file, testuser)
+        self.assertEqual(obj.id, "a31cb576-494f-40c9-af95-e756271278c3")
+        self.assertEqual(obj.size, os.path.getsize(TESTDIR + "example.zdc"))
+        self.assertEqual(len(obj.keywords.all()), 2)
+
     def test_dataset_parse_hdf5_file(self):
         pass
 
@@ -1,6 +1,8 @@
 from django.test import TestCase
 import json
 from scidatacontainer_db.models import File
+from scidatacontainer_db.parsers import _file_parser, _find_files,\
+                                        _json_loads
 
 
 class FileTest(TestCase):
@@ -51,3 +53,59 @@ class FileTest(TestCase):
         self.assertEqual(f_json.content["address"]["state"], "NY")
         self.assertEqual(f_json.content["phoneNumbers"][0]["type"], "home")
         self.assertEqual(len(f_json.content["phoneNumbers"]), 2)
+
+    def test_file_parser(self):
+        f = File(name="data.json", size=13, content={"a": 1})
+        f.save()
+
+        files = _file_parser([("data.json", 13, True, {"a": 1}),
+                              ("data.json", 13, True, {"a": 2}),
+                              ("image.png", 100, False, None),
+                              ("image.png", 100, False, None)])
+        self.assertEqual(files[0].id, f.id)
+        self.assertNotEqual(files[1].id, f.id)
+        self.assertEqual(files[1].content, {"a": 2})
+        self.assertEqual(files[2].id, files[3].id)
+        self.assertEqual(File.objects.count(), 3)
+
+        files2 = _file_parser([("image.png", 100, False, None)])
+        self.assertEqual(files2[0].id, files[2].id)
+        self.assertEqual(File.objects.count(), 3)
+
+    def test_file_parser_json_null(self):
+        f = File(name="null.json", size=4, content=[1])
+        f.save()
+
+        files = _file_parser([("null.json", 4, True, None)])
+        self.assertNotEqual(files[0].id, f.id)
+        self.assertIsNone(files[0].content)
+
+        files2 = _file_parser([("null.json", 4, True, None)])
+        self.assertEqual(files2[0].id, files[0].id)
+        self.assertEqual(File.objects.count(), 2)
+
+    def test_find_files(self):
+        for i in range(20):
+            File(name="content.json", size=700, content={"uuid": i}).save()
+        f = File(name="content.json", size=700, content={"uuid": 42})
+        f.save()
+        File(name="image.png", size=700).save()
+
+        files = [("content.json", 700, True, {"uuid": 42}),
+                 ("image.png", 100, False, None)]
+        candidates = _find_files(files)
+        self.assertEqual(candidates, {("content.json", 700): [f]})
+
+        # more files than fit into a single query
+        files = [("file" + str(i), i, False, None) for i in range(250)]
+        File(name="file249", size=249).save()
+        self.assertEqual(list(_find_files(files)), [("file249", 249)])
+
+    def test_json_loads(self):
+        for data in [b'{"a": 1.5, "b": [true, null]}',
+                     b'{"a": NaN}',
+                     b'{"a": Infinity}',
+                     b'{"a": 18446744073709551616}',
+                     b'{"a": -9223372036854775809}',
+                     b'{"a": "1234567890123456789012"}']:
+            self.assertEqual(repr(_json_loads(data)), repr(json.loads(data)))
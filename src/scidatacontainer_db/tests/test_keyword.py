@@ -1,5 +1,6 @@
 from django.test import TestCase
 from scidatacontainer_db.models import Keyword
+from scidatacontainer_db.parsers import _keyword_parser
 
 
 class KeywordTest(TestCase):
@@ -18,3 +19,17 @@ class KeywordTest(TestCase):
         self.assertTrue(isinstance(kw2, Keyword))
         self.assertEqual(str(kw2), "Testname")
         self.assertNotEqual(kw2.id, kw.id)
+
+    def test_keyword_parser(self):
+        kw = self.create_keyword("Existing")
+        kw.save()
+
+        keywords = _keyword_parser(["Existing", "New", "Existing"])
+        self.assertEqual([k.name for k in keywords],
+                         ["Existing", "New", "Existing"])
+        self.assertEqual(keywords[0].id, kw.id)
+        self.assertEqual(Keyword.objects.filter(name="Existing").count(), 1)
+        self.assertEqual(Keyword.objects.filter(name="New").count(), 1)
+
+        keywords2 = _keyword_parser(["New"])
+        self.assertEqual(keywords2[0].id, keywords[1].id)